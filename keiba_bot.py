@@ -2,8 +2,17 @@ import time
 import re
 import os
 import json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+import atexit
+import threading
+import functools
 import requests
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 from datetime import datetime
 
@@ -13,10 +22,11 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import TimeoutException, NoSuchElementException, WebDriverException
 
 # HTML Parsing & Network
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
@@ -27,6 +37,10 @@ DATA_DIR = "2025data"
 JOCKEY_FILE = os.path.join(DATA_DIR, "2025_NARJockey.csv")
 TRAINER_FILE = os.path.join(DATA_DIR, "2025_NankanTrainer.csv")
 POWER_FILE = os.path.join(DATA_DIR, "2025_騎手パワー.csv")
+KB_COOKIE_FILE = os.path.join(DATA_DIR, ".kb_cookies.json")
+RACE_CACHE_DIR = os.path.join(DATA_DIR, ".race_cache")
+RACE_CACHE_TTL = 24 * 3600
+RACE_CACHE_VERSION = 1  # 解析ロジックを変えたら上げる（古いキャッシュを読まない）
 
 # Secrets
 KEIBA_ID = st.secrets.get("KEIBA_ID", "")
@@ -34,19 +48,151 @@ KEIBA_PASS = st.secrets.get("KEIBA_PASS", "")
 DIFY_API_KEY = st.secrets.get("DIFY_API_KEY", "")
 DIFY_BASE_URL = st.secrets.get("DIFY_BASE_URL", "https://api.dify.ai")
 
+# 競馬ブックの場コード -> 場名 / 南関の場コード
+KB_PLACE_NAMES = {"10": "大井", "11": "川崎", "12": "船橋", "13": "浦和"}
+NK_PLACE_CODES = {"10": "20", "11": "21", "12": "19", "13": "18"}
+
+# 名前の区切り・空白除去用（1回の translate で全部消す）
+_NAME_TRANS = str.maketrans("", "", ", 　，")
+
+# 並列取得（requests / Dify）のワーカー数
+MAX_WORKERS = 6
+
+# 正規表現（行ごとに使うものはここで一度だけコンパイル）
+_RE_SPACES = re.compile(r"[ 　]+")
+_RE_DATE = re.compile(r"(\d+\.\d+\.\d+)")
+_RE_DIST = re.compile(r"(\d{3,4})m?")
+_RE_POP = re.compile(r"(\d+)人気")
+_RE_NUM = re.compile(r"[\d\.]+")
+_RE_META_CHARSET = re.compile(rb"charset=[\"']?([\w-]+)", re.IGNORECASE)
+_RE_ABBREV_CLEAN = re.compile(r"[ 　▲△☆◇★\d\.]+")
+_RE_KAI = re.compile(r"第\s*(\d+)\s*回")
+_RE_MON = re.compile(r"(\d+)\s*月")
+_RE_INT = re.compile(r"(\d+)")
+_RE_DASH = re.compile(r"[―-]+(.*)")
+# AI 出力の評価行（各行で最初に現れる「評価 馬名」だけを1パスで拾う。行をまたがないよう空白は改行以外）
+_RE_GRADE_LINE = re.compile(r"^[^\n]*?([SABCDE])[^\S\n]*[:：]?[^\S\n]*([^\s　]+)", re.MULTILINE)
+_RE_PAREN = re.compile(r"[（\(].*?[）\)]")
+_RE_RESULT_ID = re.compile(r"(\d{10,})")
+_RE_HR_LINE = re.compile(r"^\s*-{3,}\s*$", re.MULTILINE)
+_RE_BLANK_LINES = re.compile(r"\n{3,}")
+
+# プロンプトの馬ごとのブロック（先頭の改行が馬同士の空行区切り、この後に近走行が続く）
+_HORSE_BLOCK_TMPL = "\n[%s]%s 騎:%s 師:%s\n話:%s\n調:%s\n%s\n【近走】"
+# 番組ページのレースリンク: {年月日場(10桁)}{回}{日}{R}.do（出馬表詳細 uma_shosai は除く）
+_RE_PROGRAM_RACE = re.compile(r"""href=["'](?![^"']*uma_shosai)(?:[^"']*/)?(\d{10})\d{4}(\d{2})\.do["']""")
+
+# lxml（対戦表のような表を直接なめる箇所用）: str は UTF-8 に詰め直して渡すので meta の charset は無視させる
+_LXML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+def _xp_class(cls):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')"
+
+# 対戦表のXPath（毎回のセレクタ解釈を避けるため事前コンパイル）
+_XP_MATCHUP_TABLE = etree.XPath(f"//table[{_xp_class('nk23_c-table08__table')}]")
+# requests で取った生 HTML では <thead>/<tbody> が省略されていても補われないので、両方の形を拾う
+_XP_THEAD_CELLS = etree.XPath(
+    "./thead[1]/tr/*[self::th or self::td] | ./tr[1][not(../thead)]/*[self::th or self::td]"
+)
+_XP_DETAIL = etree.XPath(f".//*[{_xp_class('nk23_c-table08__detail')}]")
+_XP_FIRST_LINK = etree.XPath("(.//a)[1]")
+_XP_TBODY_ROWS = etree.XPath("./tbody[1]/tr | ./tr")
+_XP_HORSE_LINK = etree.XPath(f".//a[{_xp_class('nk23_c-table08__text')}]")
+_XP_CELLS = etree.XPath("./*[self::td or self::th]")
+_XP_RANK_P = etree.XPath(f"(.//p[{_xp_class('nk23_c-table08__number')}])[1]")
+_XP_FIRST_SPAN = etree.XPath("(.//span)[1]")
+
+# 出馬表詳細のXPath
+_XP_SHOSAI_TITLE = etree.XPath(f"(//h3[{_xp_class('nk23_c-tab1__title')}])[1]")
+_XP_SHOSAI_COURSE = etree.XPath(f"(//a[{_xp_class('nk23_c-tab1__subtitle__text')} and {_xp_class('is-blue')}])[1]")
+_XP_SHOSAI_TABLE = etree.XPath(f"(//*[@id='shosai_aria']//table[{_xp_class('nk23_c-table22__table')}])[1]")
+_XP_TBODY_ALL_ROWS = etree.XPath("./tbody/tr | ./tr")
+_XP_UMABAN = etree.XPath(f"(.//td[{_xp_class('umaban')}])[1]")
+_XP_UMABAN_ALT = etree.XPath(f"(.//td[{_xp_class('is-col02')}])[1]")
+_XP_HORSE_NAME_TDS = (
+    etree.XPath(f"(.//td[{_xp_class('is-col03')}])[1]"),
+    etree.XPath(f"(.//td[{_xp_class('pr-umaName-textRound')}])[1]"),
+)
+_XP_IS_LINK = etree.XPath(f"(.//a[{_xp_class('is-link')}])[1]")
+_XP_JG_TD = etree.XPath(f"(.//td[{_xp_class('cs-g1')}])[1]")
+_XP_LINKS = etree.XPath(".//a")
+_XP_AI2_TD = etree.XPath(f"(.//td[{_xp_class('cs-ai2')}])[1]")
+_XP_GRAPH_TEXT = etree.XPath(f"(.//*[{_xp_class('graph_text_div')}])[1]")
+_XP_PERCENT = etree.XPath(f"(.//*[{_xp_class('is-percent')}])[1]")
+_XP_NUMBER = etree.XPath(f"(.//*[{_xp_class('is-number')}])[1]")
+_XP_TOTAL = etree.XPath(f"(.//*[{_xp_class('is-total')}])[1]")
+_XP_HIST_TDS = tuple(etree.XPath(f"(.//td[{_xp_class(f'cs-z{i}')}])[1]") for i in range(1, 4))
+_XP_PS = etree.XPath(".//p")
+_XP_SPANS = etree.XPath(".//span")
+_XP_RANK = etree.XPath(f"(.//*[{_xp_class('nk23_u-text19')}])[1]")
+_XP_RANK_SPECIAL = etree.XPath(f"(.//*[{_xp_class('nk23_u-text16')}])[1]")
+_XP_FURLONG = etree.XPath(f"(.//*[{_xp_class('furlongtime')}])[1]")
+
+def _xp_first(xp, el):
+    r = xp(el)
+    return r[0] if r else None
+
+# 競馬ブック 談話・調教のXPath
+_XP_KB_DANWA_TABLES = etree.XPath(f"//table[{_xp_class('danwa')}]")
+_XP_KB_CYOKYO_TABLES = etree.XPath(f"//table[{_xp_class('cyokyo')}]")
+_XP_KB_UMABAN = etree.XPath(f"(.//td[{_xp_class('umaban')}])[1]")
+_XP_KB_DANWA_TD = etree.XPath(f"(.//td[{_xp_class('danwa')}])[1]")
+_XP_KB_TANPYO = etree.XPath(f"(.//td[{_xp_class('tanpyo')}])[1]")
+_XP_ALL_ROWS = etree.XPath(".//tr")
+_XP_FIRST_TD = etree.XPath("(.//td)[1]")
+_XP_ALL_TDS = etree.XPath(".//td")
+_XP_DL_TABLES = etree.XPath(f".//dl[{_xp_class('dl-table')}]")
+_XP_FIRST_DT = etree.XPath("(.//dt)[1]")
+_XP_DT_LEFT = etree.XPath(f"(.//dt[{_xp_class('left')}])[1]")
+_XP_DT_RIGHT = etree.XPath(f"(.//dt[{_xp_class('right')}])[1]")
+_XP_NEXT_TABLE = etree.XPath("following-sibling::table[1]")
+
 # ==================================================
 # ★ 先に normalize_name を定義（load_resourcesで使うため）
 # ==================================================
-def normalize_name(abbrev, full_list, priority_set=None):
+def _find_date(text):
+    """text 中の最初の「数字.数字.数字」を返す（_RE_DATE.search 相当。空白区切りの通常形は split だけで判定）"""
+    for tok in text.split():
+        if "." not in tok:
+            continue
+        parts = tok.split(".")
+        if len(parts) == 3 and all(p.isdecimal() for p in parts):
+            return tok
+        m = _RE_DATE.search(tok)
+        if m:
+            return m.group(1)
+    return ""
+
+def build_name_index(full_list):
+    """
+    normalize_name 用の索引（文字 -> その文字を含む full_list の位置集合）を作る。
+    """
+    index = {}
+    for i, full in enumerate(full_list):
+        for c in set(full):
+            index.setdefault(c, set()).add(i)
+    return index
+
+def name_normalizer(full_list, priority_set=None, index=None):
+    """
+    引数を固定した normalize_name をメモ化して返す（同じ略称はレース・近走をまたいで何度も出てくる）。
+    """
+    @functools.lru_cache(maxsize=4096)
+    def norm(abbrev):
+        return normalize_name(abbrev, full_list, priority_set, index)
+    return norm
+
+def normalize_name(abbrev, full_list, priority_set=None, index=None):
     """
     略称をフルネームに正規化する。
     priority_setが指定されている場合、そこに含まれる名前を優先する（priority_setはフルネーム集合であること）。
+    indexに build_name_index(full_list) を渡すと、全文字を含む名前だけに絞ってから判定する。
     """
     if not abbrev:
         return ""
 
     # 余計な記号・数字・空白など除去（最大3文字でもここで整う）
-    clean = re.sub(r"[ 　▲△☆◇★\d\.]+", "", str(abbrev))
+    clean = _RE_ABBREV_CLEAN.sub("", str(abbrev))
     clean = clean.strip()
     if not clean:
         return ""
@@ -54,12 +200,22 @@ def normalize_name(abbrev, full_list, priority_set=None):
     if not full_list:
         return clean
 
+    clean_chars = set(clean)
+
+    # 索引があれば「全文字を含む名前」だけを候補にする（元の並び順は維持）
+    if index is not None:
+        postings = sorted((index.get(c, set()) for c in clean_chars), key=len)
+        hits = postings[0].intersection(*postings[1:])
+        pool = [full_list[i] for i in sorted(hits)]
+    else:
+        pool = full_list
+
     # 完全一致（フルネームが来たときはそのまま）
-    if clean in full_list:
+    if clean in pool:
         return clean
 
     candidates = []
-    for full in full_list:
+    for full in pool:
         # 1) 連続一致（最優先）
         # 2) 文字が全部含まれる（次点、2～3文字でも拾える）
         if clean in full:
@@ -67,15 +223,16 @@ def normalize_name(abbrev, full_list, priority_set=None):
             is_priority = 1 if (priority_set and full in priority_set) else 0
             # 連続一致は強く優先するため、contig=0 を最優先に
             candidates.append((0, -is_priority, diff, full))
-        elif all(c in full for c in clean):
+        elif index is not None or clean_chars.issubset(full):
+            # 索引で絞った pool は全員が全文字を含むので判定不要
             diff = len(full) - len(clean)
             is_priority = 1 if (priority_set and full in priority_set) else 0
             candidates.append((1, -is_priority, diff, full))
 
     if candidates:
         # contig(0が最強) → priority(1が強いので-優先) → diff(短いほど) で決定
-        candidates.sort(key=lambda x: (x[0], x[1], x[2]))
-        return candidates[0][3]
+        # （同点は pool の並び順で先のもの。sort せず min で1回なめるだけ）
+        return min(candidates, key=lambda x: (x[0], x[1], x[2]))[3]
 
     return clean
 
@@ -88,12 +245,80 @@ def get_http_session() -> requests.Session:
     sess.headers.update({
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
     })
-    retry = Retry(total=3, backoff_factor=1, status_forcelist=(500, 502, 503, 504))
-    adapter = HTTPAdapter(max_retries=retry)
+    # 並列取得で 429 が返っても backoff で待ってから再試行する
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))
+    # 並列取得でもプールが枯渇して TCP/TLS を張り直さないよう多めに確保
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=32, pool_maxsize=64)
     sess.mount("https://", adapter)
     sess.mount("http://", adapter)
     return sess
 
+# Shift_JIS 宣言のページも実体は cp932（髙・﨑 などの機種依存文字を含む）。ブラウザ同様 cp932 で読む
+_SJIS_ALIASES = frozenset({"shift_jis", "sjis", "x_sjis", "windows_31j", "ms932", "csshiftjis"})
+
+def _response_text(res):
+    """Content-Type に charset が無ければ meta から判定して文字列化"""
+    if "charset" in res.headers.get("Content-Type", "").lower():
+        enc = res.encoding or "cp932"
+    else:
+        m = _RE_META_CHARSET.search(res.content[:4096])
+        enc = m.group(1).decode("ascii") if m else "cp932"
+    if enc.lower().replace("-", "_") in _SJIS_ALIASES:
+        enc = "cp932"
+    res.encoding = enc
+    return res.text
+
+def fetch_html(url, timeout=15):
+    """ログイン不要ページを requests で取得して文字列で返す"""
+    res = get_http_session().get(url, timeout=timeout)
+    res.raise_for_status()
+    return _response_text(res)
+
+_DRIVER_BLOCKED_URLS = [
+    "*.css", "*.woff", "*.woff2", "*.ttf", "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.webp",
+    "*google-analytics*", "*googletagmanager*", "*doubleclick*",
+]
+
+def _race_cache_path(kind, key):
+    return os.path.join(RACE_CACHE_DIR, f"{kind}_{key}_v{RACE_CACHE_VERSION}.json")
+
+def race_cache_get(kind, key):
+    """レース ID 単位のディスクキャッシュ（再起動しても同じ日の再実行で取得・解析を省く）。期限切れ・未保存は None"""
+    path = _race_cache_path(kind, key)
+    try:
+        if time.time() - os.path.getmtime(path) > RACE_CACHE_TTL:
+            os.remove(path)
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def race_cache_sweep():
+    """期限切れのキャッシュファイル（旧バージョン・書きかけの .tmp を含む）をまとめて消す"""
+    limit = time.time() - RACE_CACHE_TTL
+    try:
+        entries = list(os.scandir(RACE_CACHE_DIR))
+    except OSError:
+        return
+    for e in entries:
+        try:
+            if e.is_file() and e.stat().st_mtime < limit:
+                os.remove(e.path)
+        except OSError:
+            pass
+
+def race_cache_set(kind, key, value):
+    path = _race_cache_path(kind, key)
+    try:
+        os.makedirs(RACE_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
 def get_driver():
     ops = Options()
     ops.add_argument("--headless=new")
@@ -101,68 +326,216 @@ def get_driver():
     ops.add_argument("--disable-dev-shm-usage")
     ops.add_argument("--disable-gpu")
     ops.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36")
-    return webdriver.Chrome(options=ops)
+    # 使うのは HTML と JS だけなので画像は読まない
+    ops.add_argument("--blink-settings=imagesEnabled=false")
+    ops.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    # driver.get は DOMContentLoaded で戻す（以降の待ちはすべて WebDriverWait で要素・描画を見ている）
+    ops.page_load_strategy = "eager"
+    driver = webdriver.Chrome(options=ops)
+    # CSS・フォント・計測タグも起動時に1回だけブロックしておく（ページごとの転送と描画を減らす）
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": _DRIVER_BLOCKED_URLS})
+    except WebDriverException:
+        pass
+    return driver
+
+def lxml_root(html):
+    return lxml.html.fromstring(html.encode("utf-8"), parser=_LXML_PARSER)
+
+def lxml_text(el, sep=""):
+    """BeautifulSoup の get_text(sep, strip=True) 相当"""
+    return sep.join(t.strip() for t in el.itertext() if t.strip())
+
+_XPATH_LOGOUT = "//a[contains(@href,'logout')]"
 
 def login_keibabook_robust(driver):
     try:
-        driver.get("https://s.keibabook.co.jp/login/login")
-        time.sleep(1)
-        if "logout" in driver.current_url or driver.find_elements(By.XPATH, "//a[contains(@href,'logout')]"):
+        login_url = "https://s.keibabook.co.jp/login/login"
+        driver.get(login_url)
+        # 固定 sleep ではなく「ログインフォーム or ログアウトリンク」が出た時点で進む
+        WebDriverWait(driver, 5).until(
+            lambda d: d.find_elements(By.NAME, "login_id") or d.find_elements(By.XPATH, _XPATH_LOGOUT)
+        )
+        if "logout" in driver.current_url or driver.find_elements(By.XPATH, _XPATH_LOGOUT):
             return True
         WebDriverWait(driver, 5).until(EC.visibility_of_element_located((By.NAME, "login_id"))).send_keys(KEIBA_ID)
         driver.find_element(By.CSS_SELECTOR, "input[type='password']").send_keys(KEIBA_PASS)
         driver.find_element(By.CSS_SELECTOR, "input[type='submit']").click()
-        time.sleep(2)
+        # 送信後はログイン画面から遷移するか、ログアウトリンクが出るまで待つ
+        try:
+            WebDriverWait(driver, 5).until(
+                lambda d: d.current_url.split("?")[0] != login_url or d.find_elements(By.XPATH, _XPATH_LOGOUT)
+            )
+        except TimeoutException:
+            pass
         return True
     except Exception:
         return False
 
+def _set_session_cookies(cookies):
+    jar = get_http_session().cookies
+    for c in cookies:
+        jar.set(c["name"], c["value"], domain=c.get("domain"), path=c.get("path", "/"))
+
+def sync_driver_cookies(driver):
+    """Selenium でログインした Cookie を requests セッションへ写し、次回起動用にディスクへも保存"""
+    cookies = driver.get_cookies()
+    _set_session_cookies(cookies)
+    try:
+        with open(KB_COOKIE_FILE, "w", encoding="utf-8") as f:
+            json.dump(cookies, f)
+    except OSError:
+        pass
+
+def load_kb_cookies(min_valid_sec=600):
+    """保存済み Cookie が有効期限内なら requests セッションに載せる（Selenium ログインを丸ごと省略できる）"""
+    try:
+        with open(KB_COOKIE_FILE, encoding="utf-8") as f:
+            cookies = json.load(f)
+    except (OSError, ValueError):
+        return False
+    expiry = max((c["expiry"] for c in cookies if "expiry" in c), default=0)
+    if expiry < time.time() + min_valid_sec:
+        return False
+    _set_session_cookies(cookies)
+    return True
+
+# ドライバはプロセス内で1つを全セッション・全スレッドで共有するので、操作（ログイン・ページ遷移）は1本ずつ
+_DRIVER_LOCK = threading.RLock()
+_KB_LOGIN_STATE = {"gen": 0}  # 再ログインするたびに進める（同時に弾かれたスレッドが重ねてログインしないため）
+
+def fetch_kb_html(url, timeout=10):
+    """競馬ブック（ログイン必須）を requests で取得。ログイン画面に飛ばされたら Selenium で再ログインして Cookie を取り直す"""
+    sess = get_http_session()
+    gen = _KB_LOGIN_STATE["gen"]
+    res = sess.get(url, timeout=timeout)
+    if "login" in res.url:
+        # 再ログインは1本ずつ（ドライバもここで初めて起動する）
+        with _DRIVER_LOCK:
+            # ロック待ちの間に別スレッドがログインし直していれば、その Cookie で取り直すだけ
+            if _KB_LOGIN_STATE["gen"] == gen:
+                driver = get_logged_in_driver()
+                if login_keibabook_robust(driver):
+                    sync_driver_cookies(driver)
+                _KB_LOGIN_STATE["gen"] += 1
+        res = sess.get(url, timeout=timeout)
+        if "login" in res.url:
+            raise RuntimeError(f"競馬ブック ログイン失敗: {url}")
+    res.raise_for_status()
+    return _response_text(res)
+
+def _quit_quietly(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+@st.cache_resource
+def _get_cached_driver():
+    # Chrome 起動 + ログインは重いのでプロセス内で使い回す（終了時に quit）
+    driver = get_driver()
+    if login_keibabook_robust(driver):
+        sync_driver_cookies(driver)
+    atexit.register(_quit_quietly, driver)
+    return driver
+
+def get_logged_in_driver():
+    """ログイン済みドライバを返す。セッションが切れていれば作り直す。"""
+    with _DRIVER_LOCK:
+        driver = _get_cached_driver()
+        try:
+            driver.current_url
+        except WebDriverException:
+            _quit_quietly(driver)
+            _get_cached_driver.clear()
+            driver = _get_cached_driver()
+        return driver
+
 # ==================================================
 # 3. Dify API
 # ==================================================
+@st.cache_resource
+def get_dify_session() -> requests.Session:
+    # 認証ヘッダは Dify 専用セッションにだけ載せる（スクレイピング先へ API キーを送らない）
+    sess = requests.Session()
+    sess.headers.update({"Authorization": f"Bearer {DIFY_API_KEY}", "Content-Type": "application/json"})
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS * 2)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    return sess
+
+# SSE の data 行のうち、この文字列を含む行だけ JSON として読む
+_DIFY_EVENT_KEYS = (b"workflow_finished", b"text_chunk", b'"message"')
+_DIFY_RETRY_AFTER_MAX = 60
+
+def _retry_after_sec(res, default):
+    """429 応答の Retry-After（秒指定）を読む。無い・日付形式なら default"""
+    v = (res.headers.get("Retry-After") or "").strip()
+    if v.isdigit():
+        return min(int(v), _DIFY_RETRY_AFTER_MAX)
+    return default
+
 def run_dify_prediction(full_text):
     if not DIFY_API_KEY:
         return "⚠️ DIFY_API_KEY未設定"
     url = f"{(DIFY_BASE_URL or '').strip().rstrip('/')}/v1/workflows/run"
     payload = {"inputs": {"text": full_text}, "response_mode": "streaming", "user": "keiba-bot"}
-    headers = {"Authorization": f"Bearer {DIFY_API_KEY}", "Content-Type": "application/json"}
-    sess = get_http_session()
+    sess = get_dify_session()
 
     max_retries = 3
     for attempt in range(max_retries):
-        full_response = ""
+        chunks = []
         try:
-            with sess.post(url, headers=headers, json=payload, stream=True, timeout=120) as res:
+            with sess.post(url, json=payload, stream=True, timeout=120) as res:
                 if res.status_code == 429:
-                    time.sleep(60)
+                    # 固定 60 秒ではなくサーバ指定の待ち時間に従う。無ければ 5→10 秒と倍々（最終試行後は待たない）
+                    if attempt < max_retries - 1:
+                        time.sleep(_retry_after_sec(res, min(5 * 2 ** attempt, _DIFY_RETRY_AFTER_MAX)))
                     continue
                 if res.status_code != 200:
                     return f"⚠️ Dify Error: {res.status_code}"
 
-                for line in res.iter_lines():
-                    if line:
-                        decoded_line = line.decode("utf-8")
-                        if decoded_line.startswith("data:"):
-                            json_str = decoded_line[5:].strip()
-                            if not json_str:
-                                continue
-                            try:
-                                data = json.loads(json_str)
-                                event = data.get("event")
-                                if event == "workflow_finished":
-                                    outputs = data.get("data", {}).get("outputs", {})
-                                    if "text" in outputs:
-                                        return outputs["text"]
-                                elif event == "text_chunk" or event == "message":
-                                    chunk = data.get("data", {}).get("text", "")
-                                    full_response += chunk
-                            except:
-                                pass
+                for line in res.iter_lines(chunk_size=65536):
+                    # 使うイベント（完了・テキスト断片）以外はデコードも JSON パースもしない
+                    if line.startswith(b"data:") and any(k in line for k in _DIFY_EVENT_KEYS):
+                        json_str = line[5:].strip()
+                        if not json_str:
+                            continue
+                        try:
+                            data = _json_loads(json_str)
+                            event = data.get("event")
+                            if event == "workflow_finished":
+                                outputs = data.get("data", {}).get("outputs", {})
+                                if "text" in outputs:
+                                    return outputs["text"]
+                            elif event == "text_chunk" or event == "message":
+                                chunks.append(data.get("data", {}).get("text", ""))
+                        except:
+                            pass
+                # 断片は都度連結せずリストに溜めて最後に1回だけ join する
+                full_response = "".join(chunks)
                 return full_response if full_response else "（回答生成エラー）"
         except Exception:
-            time.sleep(5)
+            if attempt < max_retries - 1:
+                time.sleep(2 ** attempt)
     return "⚠️ エラー: リトライ上限を超えました"
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def _run_dify_cached(full_text):
+    out = run_dify_prediction(full_text)
+    # エラー応答はキャッシュしない（st.cache_data は例外時に保存しない）
+    if out.startswith("⚠️") or out == "（回答生成エラー）":
+        raise RuntimeError(out)
+    return out
+
+def run_dify_prediction_cached(full_text):
+    """同一プロンプトの再実行（Streamlit の rerun 等）は Dify を呼ばずにキャッシュを返す"""
+    try:
+        return _run_dify_cached(full_text)
+    except RuntimeError as e:
+        return str(e)
+
 # ==================================================
 # 4. データロード & 解析 (★近走騎手名フルネーム化が確実に叶う版)
 # ==================================================
@@ -172,9 +545,16 @@ def load_resources():
         "jockeys": [],        # ★フルネームのみ（JOCKEY_FILE由来）
         "trainers": [],
         "power_data": {},     # (場所, 騎手フル名) -> {power, win, fuku}
-        "power_jockeys": set()  # ★フルネーム集合（priority用）
+        "power_jockeys": set(),  # ★フルネーム集合（priority用）
+        "jockeys_index": {},  # normalize_name 用索引
+        "trainers_index": {},
+        "norm_jockey": None,  # 騎手名の正規化（メモ化済み）
+        "norm_trainer": None,  # 調教師名の正規化（メモ化済み）
     }
 
+    # プロセス起動時に1回だけ、レース単位ディスクキャッシュの期限切れを掃除する
+    race_cache_sweep()
+
     # パス解決ヘルパー
     def get_valid_path(target_path):
         if os.path.exists(target_path):
@@ -187,80 +567,81 @@ def load_resources():
             return basename
         return None
 
-    # 1. 騎手・調教師リスト読み込み（フルネーム想定）
-    j_path = get_valid_path(JOCKEY_FILE)
-    if j_path:
+    # 1行1名のテキストを一括で読み、記号・空白の除去もファイル全体に1回だけかける
+    def read_name_list(path):
         for enc in ["utf-8-sig", "cp932"]:
             try:
-                with open(j_path, "r", encoding=enc) as f:
-                    # ★1行1名の前提でフルネームだけを作る
-                    res["jockeys"] = [
-                        l.strip().replace(" ", "").replace("　", "")
-                        for l in f if l.strip()
-                    ]
-                break
-            except:
+                with open(path, "r", encoding=enc) as f:
+                    txt = f.read()
+            except (OSError, UnicodeError):
                 continue
+            return [l.strip() for l in txt.translate(_NAME_TRANS).split("\n") if l.strip()]
+        return []
+
+    # 1. 騎手・調教師リスト読み込み（フルネーム想定）
+    # ★1行1名の前提でフルネームだけを作る
+    j_path = get_valid_path(JOCKEY_FILE)
+    if j_path:
+        res["jockeys"] = read_name_list(j_path)
 
     t_path = get_valid_path(TRAINER_FILE)
     if t_path:
-        for enc in ["utf-8-sig", "cp932"]:
-            try:
-                with open(t_path, "r", encoding=enc) as f:
-                    res["trainers"] = [
-                        l.strip().replace(",", "").replace(" ", "").replace("　", "")
-                        for l in f if l.strip()
-                    ]
-                break
-            except:
-                continue
+        res["trainers"] = read_name_list(t_path)
+
+    res["jockeys_index"] = build_name_index(res["jockeys"])
+    res["trainers_index"] = build_name_index(res["trainers"])
 
     # 2. 騎手パワーCSV読み込み
     # ★ここが重要：POWER_FILE側の騎手名（短縮表記の可能性あり）をフルネームに正規化して保存する
     p_path = get_valid_path(POWER_FILE)
     if p_path:
-        df = None
         for enc in ["utf-8-sig", "cp932"]:
             try:
-                df = pd.read_csv(p_path, encoding=enc)
-                break
-            except:
-                continue
-
-        if df is not None:
-            try:
-                place_col = df.columns[0]
-                has_win = "勝率" in df.columns
-                has_fuku = "複勝率" in df.columns
-                has_power = "騎手パワー" in df.columns
-                has_name = "騎手名" in df.columns
-
-                for _, row in df.iterrows():
-                    p = str(row[place_col]).strip()
-                    j_raw = row["騎手名"] if has_name else ""
-                    j_raw = str(j_raw).replace(" ", "").replace("　", "").strip()
-
-                    if not j_raw or not p:
-                        continue
+                header = pd.read_csv(p_path, encoding=enc, nrows=0).columns
+                if "騎手名" not in header:
+                    break
+                place_col = header[0]
+                # 必要な列だけを文字列として、チャンク単位で読む（ピークメモリを抑える）
+                value_cols = [c for c in ("騎手パワー", "勝率", "複勝率") if c in header]
+                usecols = [0, header.get_loc("騎手名")] + [header.get_loc(c) for c in value_cols]
+
+                power_data, power_jockeys, full_map = {}, set(), {}
+                for df in pd.read_csv(p_path, encoding=enc, usecols=usecols, dtype=str, chunksize=10000):
+                    # 列単位でまとめて文字列化・空白除去（行ごとの Series 生成を避ける）
+                    places = df[place_col].astype(str).str.strip()
+                    names = (
+                        df["騎手名"].astype(str)
+                        .str.translate(_NAME_TRANS)
+                        .str.strip()
+                    )
+
+                    def col_or_dash(col):
+                        return df[col].astype(str).str.strip() if col in value_cols else pd.Series("-", index=df.index)
+
+                    mask = (places != "") & (names != "")
+                    places, names = places[mask], names[mask]
+                    powers = col_or_dash("騎手パワー")[mask]
+                    wins = col_or_dash("勝率")[mask]
+                    fukus = col_or_dash("複勝率")[mask]
 
                     # ★POWER側の名前を「フルネーム候補」に正規化（ここで最大3文字→フル名へ）
-                    j_full = normalize_name(j_raw, res["jockeys"], priority_set=None)
-
-                    # power_jockeys はフルネーム集合（priority用）
-                    if j_full:
-                        res["power_jockeys"].add(j_full)
-
-                    val_power = str(row["騎手パワー"]) if has_power else "-"
-                    val_win = str(row["勝率"]) if has_win else "-"
-                    val_fuku = str(row["複勝率"]) if has_fuku else "-"
-
-                    # ★キー: (場所, 騎手フル名) に統一
-                    key_t = (p, j_full if j_full else j_raw)
-                    res["power_data"][key_t] = {
-                        "power": val_power,
-                        "win": val_win,
-                        "fuku": val_fuku
-                    }
+                    # 同じ騎手は場所ごとに複数行あるので、ユニークな名前だけ正規化する
+                    for j in names.unique():
+                        if j not in full_map:
+                            full_map[j] = normalize_name(j, res["jockeys"], priority_set=None, index=res["jockeys_index"])
+
+                    # ★キー: (場所, 騎手フル名) に統一（Series ではなく生の配列を zip する）
+                    power_data.update(
+                        ((p, full_map[j] or j), {"power": v_power, "win": v_win, "fuku": v_fuku})
+                        for p, j, v_power, v_win, v_fuku in zip(
+                            places.to_numpy(), names.to_numpy(), powers.to_numpy(), wins.to_numpy(), fukus.to_numpy()
+                        )
+                    )
+
+                # power_jockeys はフルネーム集合（priority用）
+                power_jockeys.update(j for j in full_map.values() if j)
+                res["power_data"] = power_data
+                res["power_jockeys"] = power_jockeys
 
                 # ★ここは削除：POWER_FILE由来の「短い騎手名」を jockeys に混ぜない
                 # （混ぜると normalize_name が短い方で確定してしまい、フルネーム化が失敗する）
@@ -268,429 +649,542 @@ def load_resources():
                 # for j in res["power_jockeys"]:
                 #     if j not in current_jockeys:
                 #         res["jockeys"].append(j)
-
+                break
             except Exception:
-                pass
+                continue
+
+    # レース解析用の正規化関数（POWER 由来のフルネームを優先）
+    res["norm_jockey"] = name_normalizer(res["jockeys"], res["power_jockeys"], res["jockeys_index"])
+    res["norm_trainer"] = name_normalizer(res["trainers"], None, res["trainers_index"])
 
     return res
 
+# 近走の開催場（略称1文字 -> 場名）
+_PLACE_MAP = {"船": "船橋", "大": "大井", "川": "川崎", "浦": "浦和", "門": "門別", "盛": "盛岡", "水": "水沢", "笠": "笠松", "名": "名古屋", "園": "園田", "姫": "姫路", "高": "高知", "佐": "佐賀"}
+_KNOWN_PLACES = list(_PLACE_MAP.values()) + ["JRA"]
+
+@functools.lru_cache(maxsize=2048)
+def _date_place(d_raw):
+    """近走の日付行 -> (日付, 開催場)。同じ開催の行は馬をまたいで何度も出るのでメモ化"""
+    d_txt = _find_date(d_raw)
+    rem_text = d_raw.replace(d_txt, "") if d_txt else d_raw
+    for kp in _KNOWN_PLACES:
+        if kp in rem_text:
+            return d_txt, kp
+    for k, v in _PLACE_MAP.items():
+        if k in rem_text:
+            return d_txt, v
+    return d_txt, ""
+
+def _parse_shosai_row(row, place_name, norm_jockey, norm_trainer, power_get):
+    """出馬表詳細の1行を (馬番, 馬データ) にする。馬番が取れない行は None"""
+    u_tag = _xp_first(_XP_UMABAN, row)
+    if u_tag is None:
+        u_tag = _xp_first(_XP_UMABAN_ALT, row)
+    if u_tag is None:
+        return None
+    umaban = lxml_text(u_tag)
+    if not umaban.isdigit():
+        return None
+    h_link = None
+    for xp_td in _XP_HORSE_NAME_TDS:
+        name_td = _xp_first(xp_td, row)
+        h_link = _xp_first(_XP_IS_LINK, name_td) if name_td is not None else None
+        if h_link is not None:
+            break
+    horse_name = lxml_text(h_link) if h_link is not None else "不明"
+
+    # --- 今回の騎手・調教師 ---
+    jg_td = _xp_first(_XP_JG_TD, row)
+    j_raw, t_raw = "", ""
+    if jg_td is not None:
+        links = _XP_LINKS(jg_td)
+        if len(links) >= 1:
+            j_raw = lxml_text(links[0])
+        if len(links) >= 2:
+            t_raw = lxml_text(links[1])
+
+    # 正規化
+    j_full = norm_jockey(j_raw)
+    t_full = norm_trainer(t_raw)
+
+    # --- 今回の騎手データ ---
+    p_data_curr = power_get((place_name, j_full))
+    curr_power_str = "P:不明"
+    if p_data_curr:
+        cp = p_data_curr["power"]
+        cw = p_data_curr["win"].replace("%", "")
+        cf = p_data_curr["fuku"].replace("%", "")
+        curr_power_str = f"P:{cp}(勝{cw}%複{cf}%)"
+
+    ai2_td = _xp_first(_XP_AI2_TD, row)
+    ai2 = _xp_first(_XP_GRAPH_TEXT, ai2_td) if ai2_td is not None else None
+    pair_stats = "-"
+    if ai2 is not None and "データ" not in "".join(ai2.itertext()):
+        r = lxml_text(_XP_PERCENT(ai2)[0])
+        w = lxml_text(_XP_NUMBER(ai2)[0])
+        t = lxml_text(_XP_TOTAL(ai2)[0])
+        pair_stats = f"勝{r}({w}/{t})"
+
+    history = []
+    add_hist = history.append
+    prev_power_val = None
+
+    # --- 近走データ (最大3走) ---
+    for i, xp_z in enumerate(_XP_HIST_TDS, 1):
+        z = _xp_first(xp_z, row)
+        if z is None:
+            continue
+        z_full_text = lxml_text(z, " ")
+        if not z_full_text:
+            continue
+
+        # <p> は1回だけ走査して用途ごとに振り分ける（日付行・人気行・通過順）
+        d_div = pop_p = pos_p = None
+        for p in _XP_PS(z):
+            cls = (p.get("class") or "").split()
+            if d_div is None and "nk23_u-d-flex" in cls:
+                d_div = p
+            if pos_p is None and "position" in cls:
+                pos_p = p
+            if pop_p is None and "nk23_u-text10" in cls:
+                pop_txt = lxml_text(p)
+                if "人気" in pop_txt:
+                    pop_p = p
+            if d_div is not None and pop_p is not None and pos_p is not None:
+                break
+
+        # 1. 日付と開催場
+        d_txt = ""
+        place_short = ""
+
+        if d_div is not None:
+            d_txt, place_short = _date_place(lxml_text(d_div, " "))
+
+        if not d_txt:
+            d_txt = "不明"
+        if not place_short:
+            place_short = place_name
+
+        # 2. 距離
+        dm = _RE_DIST.search(z_full_text)
+        dist = dm.group(1) if dm else ""
+
+        # ==================================================
+        # ★ 3. 着順 (修正：能試・取消・除外に対応)
+        # ==================================================
+        rank = ""
+        # 通常の着順タグ (例: 1着, 2着...)
+        r_tag = _xp_first(_XP_RANK, z)
+        
+        if r_tag is not None:
+            # 数字のみを取り出す
+            rank = lxml_text(r_tag).replace("着", "")
+        else:
+            # 着順がない場合、特殊タグ(能試、取消、除外など)を探す
+            special_tag = _xp_first(_XP_RANK_SPECIAL, z)
+            if special_tag is not None:
+                # "能試" や "取消" という文字をそのまま取得
+                rank = lxml_text(special_tag)
+        # ==================================================
+
+        # 4. 騎手(略称)・人気
+        j_prev, pop = "", ""
+        if pop_p is not None:
+            pm = _RE_POP.search(pop_txt)
+            if pm:
+                pop = f"{pm.group(1)}人"
+            spans = _XP_SPANS(pop_p)
+            if len(spans) >= 2:
+                j_cand = lxml_text(spans[1])
+                j_prev = _RE_NUM.sub("", j_cand)
+
+        # 5. 上がり3F (タグ取得版)
+        agari = ""
+        ft_elem = _xp_first(_XP_FURLONG, z)
+        if ft_elem is not None:
+            raw_agari = lxml_text(ft_elem)
+            if raw_agari:
+                agari = raw_agari
+
+        # 6. 通過順
+        pas = ""
+        if pos_p is not None:
+            pas_spans = [lxml_text(s) for s in _XP_SPANS(pos_p)]
+            pas = "-".join(pas_spans)
+
+        # 7. 騎手名の正規化
+        j_prev_full = norm_jockey(j_prev)
+        if not j_prev_full and j_prev:
+            j_prev_full = j_prev
+
+        # ★ 前走(i=1)のP取得 ★
+        if i == 1:
+            p_data_prev = power_get((place_short, j_prev_full))
+            if p_data_prev:
+                prev_power_val = p_data_prev["power"]
+
+        # ==================================================
+        # ★ 文字列生成 (修正：着順の表示分け)
+        # ==================================================
+        agari_part = f"({agari})" if agari else ""
+        pop_part = f"({pop})" if pop else ""
+        
+        # rankが数字なら「着」をつける。それ以外（能試・取消など）ならそのまま表示。
+        if rank.isdigit():
+            rank_part = f"{rank}着"
+        elif rank:
+            rank_part = rank  # "能試", "取消" など
+        else:
+            rank_part = "着不明"
+
+        h_str = f"{d_txt} {place_short}{dist} {j_prev_full} {pas}{agari_part}→{rank_part}{pop_part}"
+        add_hist(h_str)
+        # ==================================================
+    # --- 最終表示用 ---
+    if prev_power_val:
+        power_line = f"【騎手】{curr_power_str}(前P:{prev_power_val})、 相性:{pair_stats}"
+    else:
+        power_line = f"【騎手】{curr_power_str}、 相性:{pair_stats}"
+
+    return umaban, {
+        "name": horse_name, "jockey": j_full, "trainer": t_full,
+        "power": curr_power_str,
+        "compat": pair_stats, "hist": history,
+        "display_power": power_line
+    }
+
 def parse_nankankeiba_detail(html, place_name, resources):
-    soup = BeautifulSoup(html, "html.parser")
     data = {"meta": {}, "horses": {}}
 
-    h3 = soup.find("h3", class_="nk23_c-tab1__title")
-    data["meta"]["race_name"] = h3.get_text(strip=True) if h3 else ""
+    # BeautifulSoup の Python ツリーは作らず、lxml のツリーを事前コンパイル済み XPath で直接なめる
+    root = lxml_root(html)
+
+    # レース名・コース
+    h3 = _xp_first(_XP_SHOSAI_TITLE, root)
+    data["meta"]["race_name"] = lxml_text(h3) if h3 is not None else ""
     if data["meta"]["race_name"]:
-        parts = re.split(r"[ 　]+", data["meta"]["race_name"])
+        parts = _RE_SPACES.split(data["meta"]["race_name"])
         data["meta"]["grade"] = parts[-1] if len(parts) > 1 else ""
-    cond = soup.select_one("a.nk23_c-tab1__subtitle__text.is-blue")
-    data["meta"]["course"] = f"{place_name} {cond.get_text(strip=True)}" if cond else ""
-
-    shosai_area = soup.select_one("#shosai_aria")
-    if not shosai_area:
-        return data
+    cond = _xp_first(_XP_SHOSAI_COURSE, root)
+    data["meta"]["course"] = f"{place_name} {lxml_text(cond)}" if cond is not None else ""
 
-    table = shosai_area.select_one("table.nk23_c-table22__table")
-    if not table:
+    # 出走馬テーブル
+    table = _xp_first(_XP_SHOSAI_TABLE, root)
+    if table is None:
         return data
 
-    PLACE_MAP = {"船": "船橋", "大": "大井", "川": "川崎", "浦": "浦和", "門": "門別", "盛": "盛岡", "水": "水沢", "笠": "笠松", "名": "名古屋", "園": "園田", "姫": "姫路", "高": "高知", "佐": "佐賀"}
-    KNOWN_PLACES = list(PLACE_MAP.values()) + ["JRA"]
+    # 行・近走ループで毎回引く resources はループの外で一度だけ取り出す
+    norm_jockey, norm_trainer = resources["norm_jockey"], resources["norm_trainer"]
+    power_get = resources["power_data"].get
 
-    for row in table.select("tbody tr"):
+    # 直下の tbody/tr だけを見る（セル内の入れ子要素まで降りない）
+    for row in _XP_TBODY_ALL_ROWS(table):
         try:
-            u_tag = row.select_one("td.umaban") or row.select_one("td.is-col02")
-            if not u_tag:
-                continue
-            umaban = u_tag.get_text(strip=True)
-            if not umaban.isdigit():
-                continue
-            h_link = row.select_one("td.is-col03 a.is-link") or row.select_one("td.pr-umaName-textRound a.is-link")
-            horse_name = h_link.get_text(strip=True) if h_link else "不明"
-
-            # --- 今回の騎手・調教師 ---
-            jg_td = row.select_one("td.cs-g1")
-            j_raw, t_raw = "", ""
-            if jg_td:
-                links = jg_td.select("a")
-                if len(links) >= 1:
-                    j_raw = links[0].get_text(strip=True)
-                if len(links) >= 2:
-                    t_raw = links[1].get_text(strip=True)
-
-            # 正規化
-            j_full = normalize_name(j_raw, resources["jockeys"], resources["power_jockeys"])
-            t_full = normalize_name(t_raw, resources["trainers"], None)
-
-            # --- 今回の騎手データ ---
-            p_data_curr = resources["power_data"].get((place_name, j_full))
-            curr_power_str = "P:不明"
-            if p_data_curr:
-                cp = p_data_curr["power"]
-                cw = p_data_curr["win"].replace("%", "")
-                cf = p_data_curr["fuku"].replace("%", "")
-                curr_power_str = f"P:{cp}(勝{cw}%複{cf}%)"
-
-            ai2 = row.select_one("td.cs-ai2 .graph_text_div")
-            pair_stats = "-"
-            if ai2 and "データ" not in ai2.get_text():
-                r = ai2.select_one(".is-percent").get_text(strip=True)
-                w = ai2.select_one(".is-number").get_text(strip=True)
-                t = ai2.select_one(".is-total").get_text(strip=True)
-                pair_stats = f"勝{r}({w}/{t})"
-
-            history = []
-            prev_power_val = None
-
-            # --- 近走データ (最大3走) ---
-            for i in range(1, 4):
-                z = row.select_one(f"td.cs-z{i}")
-                if not z:
-                    continue
-                z_full_text = z.get_text(" ", strip=True)
-                if not z_full_text:
-                    continue
-
-                # 1. 日付と開催場
-                d_txt = ""
-                place_short = ""
-                d_div = z.select_one("p.nk23_u-d-flex")
-
-                if d_div:
-                    d_raw = d_div.get_text(" ", strip=True)
-                    m_dt = re.search(r"(\d+\.\d+\.\d+)", d_raw)
-                    if m_dt:
-                        d_txt = m_dt.group(1)
-
-                    rem_text = d_raw.replace(d_txt, "") if d_txt else d_raw
-                    for kp in KNOWN_PLACES:
-                        if kp in rem_text:
-                            place_short = kp
-                            break
-                    if not place_short:
-                        for k, v in PLACE_MAP.items():
-                            if k in rem_text:
-                                place_short = v
-                                break
-
-                if not d_txt:
-                    d_txt = "不明"
-                if not place_short:
-                    place_short = place_name
-
-                # 2. 距離
-                dm = re.search(r"(\d{3,4})m?", z_full_text)
-                dist = dm.group(1) if dm else ""
-
-                # ==================================================
-                # ★ 3. 着順 (修正：能試・取消・除外に対応)
-                # ==================================================
-                rank = ""
-                # 通常の着順タグ (例: 1着, 2着...)
-                r_tag = z.select_one(".nk23_u-text19")
-                
-                if r_tag:
-                    # 数字のみを取り出す
-                    rank = r_tag.get_text(strip=True).replace("着", "")
-                else:
-                    # 着順がない場合、特殊タグ(能試、取消、除外など)を探す
-                    special_tag = z.select_one(".nk23_u-text16")
-                    if special_tag:
-                        # "能試" や "取消" という文字をそのまま取得
-                        rank = special_tag.get_text(strip=True)
-                # ==================================================
-
-                # 4. 騎手(略称)・人気
-                j_prev, pop = "", ""
-                p_lines = z.select("p.nk23_u-text10")
-                for p in p_lines:
-                    txt = p.get_text(strip=True)
-                    if "人気" in txt:
-                        pm = re.search(r"(\d+)人気", txt)
-                        if pm:
-                            pop = f"{pm.group(1)}人"
-                        spans = p.find_all("span")
-                        if len(spans) >= 2:
-                            j_cand = spans[1].get_text(strip=True)
-                            j_prev = re.sub(r"[\d\.]+", "", j_cand)
-                        break
-
-                # 5. 上がり3F (タグ取得版)
-                agari = ""
-                ft_elem = z.select_one(".furlongtime")
-                if ft_elem:
-                    raw_agari = ft_elem.get_text(strip=True)
-                    if raw_agari:
-                        agari = raw_agari
-
-                # 6. 通過順
-                pos_p = z.select_one("p.position")
-                pas = ""
-                if pos_p:
-                    pas_spans = [s.get_text(strip=True) for s in pos_p.find_all("span")]
-                    pas = "-".join(pas_spans)
-
-                # 7. 騎手名の正規化
-                j_prev_full = normalize_name(j_prev, resources["jockeys"], resources["power_jockeys"])
-                if not j_prev_full and j_prev:
-                    j_prev_full = j_prev
-
-                # ★ 前走(i=1)のP取得 ★
-                if i == 1:
-                    p_key = (place_short, j_prev_full)
-                    p_data_prev = resources["power_data"].get(p_key)
-                    if p_data_prev:
-                        prev_power_val = p_data_prev["power"]
-
-                # ==================================================
-                # ★ 文字列生成 (修正：着順の表示分け)
-                # ==================================================
-                agari_part = f"({agari})" if agari else ""
-                pop_part = f"({pop})" if pop else ""
-                
-                # rankが数字なら「着」をつける。それ以外（能試・取消など）ならそのまま表示。
-                if rank.isdigit():
-                    rank_part = f"{rank}着"
-                elif rank:
-                    rank_part = rank  # "能試", "取消" など
-                else:
-                    rank_part = "着不明"
-
-                h_str = f"{d_txt} {place_short}{dist} {j_prev_full} {pas}{agari_part}→{rank_part}{pop_part}"
-                history.append(h_str)
-                # ==================================================
-            # --- 最終表示用 ---
-            if prev_power_val:
-                power_line = f"【騎手】{curr_power_str}(前P:{prev_power_val})、 相性:{pair_stats}"
-            else:
-                power_line = f"【騎手】{curr_power_str}、 相性:{pair_stats}"
-
-            data["horses"][umaban] = {
-                "name": horse_name, "jockey": j_full, "trainer": t_full,
-                "power": curr_power_str,
-                "compat": pair_stats, "hist": history,
-                "display_power": power_line
-            }
-
+            parsed = _parse_shosai_row(row, place_name, norm_jockey, norm_trainer, power_get)
         except Exception:
             continue
+        if parsed is not None:
+            umaban, horse = parsed
+            data["horses"][umaban] = horse
+
     return data
 # ==================================================
 # 5. ヘルパー関数 (URL, カレンダー等)
 # ==================================================
-def get_nankan_kai_nichi(month, day, place_name):
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_kai_nichi(month, day, place_name):
     url = "https://www.nankankeiba.com/bangumi_menu/bangumi.do"
     sess = get_http_session()
+    res = sess.get(url, timeout=10)
+    # cp932 で1回だけ str にしてから lxml に渡す（パーサ側で文字コードを推測させない）
+    root = lxml_root(res.content.decode("cp932", "ignore"))
+    target_m, target_d = int(month), int(day)
+    for tr in _XP_ALL_ROWS(root):
+        text = lxml_text(tr, " ")
+        if place_name not in text:
+            continue
+        kai_m = _RE_KAI.search(text)
+        mon_m = _RE_MON.search(text)
+        if kai_m and mon_m and int(mon_m.group(1)) == target_m:
+            days_part = text.split("月")[1]
+            days_match = _RE_INT.findall(days_part)
+            days_list = [int(d) for d in days_match if 1 <= int(d) <= 31]
+            if target_d in days_list:
+                return int(kai_m.group(1)), days_list.index(target_d) + 1
+    # 見つからない結果はキャッシュしない（st.cache_data は例外時に保存しない）
+    raise LookupError(place_name)
+
+def get_nankan_kai_nichi(month, day, place_name):
+    """開催回・日目を返す（同じ日付・場の再実行では番組メニューを取り直さない）"""
     try:
-        res = sess.get(url, timeout=10)
-        res.encoding = "cp932"
-        soup = BeautifulSoup(res.text, "html.parser")
-        target_m, target_d = int(month), int(day)
-        for tr in soup.find_all("tr"):
-            text = tr.get_text(" ", strip=True)
-            if place_name not in text:
-                continue
-            kai_m = re.search(r"第\s*(\d+)\s*回", text)
-            mon_m = re.search(r"(\d+)\s*月", text)
-            if kai_m and mon_m and int(mon_m.group(1)) == target_m:
-                days_part = text.split("月")[1]
-                days_match = re.findall(r"(\d+)", days_part)
-                days_list = [int(d) for d in days_match if 1 <= int(d) <= 31]
-                if target_d in days_list:
-                    return int(kai_m.group(1)), days_list.index(target_d) + 1
-        return None, None
-    except:
+        return _fetch_kai_nichi(month, day, place_name)
+    except Exception:
         return None, None
 
-def get_kb_url_id(year, month, day, place_code, nichi, race_num):
-    return f"{year}{str(month).zfill(2)}{str(place_code).zfill(2)}{str(nichi).zfill(2)}{str(race_num).zfill(2)}{str(month).zfill(2)}{str(day).zfill(2)}"
-
-def parse_kb_danwa_cyokyo(driver, kb_id):
-    d_danwa, d_cyokyo = {}, {}
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_program_race_nums(year, month, day, nk_place_code):
+    # DOM は組まずに生 HTML へ正規表現を1回かけて対象日のレース番号を拾い、set で重複除去
+    day_key = f"{year}{month}{day}{nk_place_code}"
+    html = fetch_html(f"https://www.nankankeiba.com/program/{day_key}.do")
+    r_nums = sorted({int(r) for key, r in _RE_PROGRAM_RACE.findall(html) if key == day_key})
+    if not r_nums:
+        raise LookupError(day_key)
+    return r_nums
+
+def get_program_race_nums(year, month, day, nk_place_code):
+    """番組ページから対象日のレース番号を返す。取れなければ 1〜12R"""
     try:
-        # --- 厩舎の話 (Danwa) ---
-        driver.get(f"https://s.keibabook.co.jp/chihou/danwa/1/{kb_id}")
-        if "login" in driver.current_url:
-            if login_keibabook_robust(driver):
-                driver.get(f"https://s.keibabook.co.jp/chihou/danwa/1/{kb_id}")
-        
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        for tbl in soup.select("table.danwa"):
-            curr = None
-            for tr in tbl.select("tbody tr"):
-                u = tr.select_one("td.umaban")
-                if u:
-                    curr = u.get_text(strip=True)
-                    continue
-                t = tr.select_one("td.danwa")
-                if curr and t:
-                    raw_text = t.get_text(" ", strip=True)
-                    m = re.search(r"[―-]+(.*)", raw_text)
-                    d_danwa[curr] = m.group(1).strip() if m else raw_text
-                    curr = None
+        return _fetch_program_race_nums(year, month, day, nk_place_code)
+    except (LookupError, requests.RequestException):
+        # 取得失敗（HTTP エラー・接続エラー）も全レース扱いで続行する（例外なのでキャッシュはされない）
+        return list(range(1, 13))
 
-        # --- 調教 (Cyokyo) ---
-        driver.get(f"https://s.keibabook.co.jp/chihou/cyokyo/1/{kb_id}")
-        soup = BeautifulSoup(driver.page_source, "html.parser")
+def kb_url_id_format(year, month, day, place_code):
+    """競馬ブックのレース ID 書式（開催日で決まる部分は埋め済み、残りは % (日目, R) で埋める）"""
+    mm = str(month).zfill(2)
+    return f"{year}{mm}{str(place_code).zfill(2)}%02d%02d{mm}{str(day).zfill(2)}"
 
-        # 1頭ごとに table.cyokyo が分かれている構造
-        for tbl in soup.select("table.cyokyo"):
-            try:
-                # 馬番取得
-                u_td = tbl.select_one("td.umaban")
-                if not u_td:
-                    continue
-                uma = u_td.get_text(strip=True)
+def get_kb_url_id(year, month, day, place_code, nichi, race_num):
+    return kb_url_id_format(year, month, day, place_code) % (int(nichi), int(race_num))
+
+def _parse_kb_danwa(html):
+    d_danwa = {}
+    root = lxml_root(html)
+    for tbl in _XP_KB_DANWA_TABLES(root):
+        curr = None
+        for tr in _XP_TBODY_ALL_ROWS(tbl):
+            u = _xp_first(_XP_KB_UMABAN, tr)
+            if u is not None:
+                curr = lxml_text(u)
+                continue
+            t = _xp_first(_XP_KB_DANWA_TD, tr)
+            if curr and t is not None:
+                raw_text = lxml_text(t, " ")
+                m = _RE_DASH.search(raw_text)
+                d_danwa[curr] = m.group(1).strip() if m else raw_text
+                curr = None
+    return d_danwa
+
+def _parse_kb_cyokyo(html):
+    d_cyokyo = {}
+    root = lxml_root(html)
+
+    # 1頭ごとに table.cyokyo が分かれている構造
+    for tbl in _XP_KB_CYOKYO_TABLES(root):
+        try:
+            # 馬番取得
+            u_td = _xp_first(_XP_KB_UMABAN, tbl)
+            if u_td is None:
+                continue
+            uma = lxml_text(u_td)
 
-                # 短評取得
-                tp_td = tbl.select_one("td.tanpyo")
-                tp_txt = tp_td.get_text(strip=True) if tp_td else ""
+            # 短評取得
+            tp_td = _xp_first(_XP_KB_TANPYO, tbl)
+            tp_txt = lxml_text(tp_td) if tp_td is not None else ""
 
-                # 詳細データ取得（2行目の td 内にある）
-                rows = tbl.find_all("tr")
-                if len(rows) < 2:
-                    d_cyokyo[uma] = f"【短評】{tp_txt}"
-                    continue
+            # 詳細データ取得（2行目の td 内にある）
+            rows = _XP_ALL_ROWS(tbl)
+            if len(rows) < 2:
+                d_cyokyo[uma] = f"【短評】{tp_txt}"
+                continue
 
-                content_td = rows[1].find("td")
-                if not content_td:
-                    d_cyokyo[uma] = f"【短評】{tp_txt}"
-                    continue
+            content_td = _xp_first(_XP_FIRST_TD, rows[1])
+            if content_td is None:
+                d_cyokyo[uma] = f"【短評】{tp_txt}"
+                continue
 
-                cyokyo_lines = []
-                
-                # dl (ヘッダ) と table (タイム) が交互に並んでいる
-                # dlクラスを持つ要素を全て取得し、その直後のテーブルを探す
-                dls = content_td.select("dl.dl-table")
-                
-                for dl in dls:
-                    # --- ラベル判定（前走 vs 今走） ---
-                    # 最初の dt タグの中身を確認
-                    first_dt = dl.find("dt")
-                    first_dt_text = first_dt.get_text(strip=True) if first_dt else ""
-                    
-                    if "(前回)" in first_dt_text:
-                        label = "前走向け調教"
-                    else:
-                        # 空白やそれ以外の場合は今走扱い
-                        label = "今走向け調教"
-
-                    # --- 日付・場所・馬場状態 ---
-                    dt_left = dl.select_one("dt.left")
-                    info_text = dt_left.get_text(" ", strip=True) if dt_left else ""
-                    dt_right = dl.select_one("dt.right")
-                    cond_text = dt_right.get_text(strip=True) if dt_right else ""
-
-                    # --- タイムデータ (直後の兄弟要素の table を探す) ---
-                    next_node = dl.find_next_sibling()
-                    while next_node and next_node.name != 'table':
-                        next_node = next_node.find_next_sibling()
-                    
-                    time_data = ""
-                    if next_node and "cyokyodata" in next_node.get("class", []):
-                        # テーブル内のテキストを行ごとに取得
-                        data_rows = []
-                        for tr in next_node.select("tr"):
-                            # タイムや併せ馬情報の取得
-                            cells = [td.get_text(strip=True) for td in tr.find_all("td") if td.get_text(strip=True)]
-                            if cells:
-                                data_rows.append(" ".join(cells))
-                        time_data = " / ".join(data_rows)
-
-                    # 行を作成: "前走向け調教：12/26 浦和調教場 重 馬なり 59.2 42.8"
-                    cyokyo_lines.append(f"{label}：{info_text} {cond_text} {time_data}")
-
-                # 最終的な文字列生成
-                full_text = f"【短評】{tp_txt}"
-                if cyokyo_lines:
-                    full_text += "\n" + "\n".join(cyokyo_lines)
-                
-                d_cyokyo[uma] = full_text
+            cyokyo_lines = []
 
-            except Exception:
-                continue
+            # dl (ヘッダ) と table (タイム) が交互に並んでいる
+            # dlクラスを持つ要素を全て取得し、その直後のテーブルを探す
+            for dl in _XP_DL_TABLES(content_td):
+                # --- ラベル判定（前走 vs 今走） ---
+                # 最初の dt タグの中身を確認
+                first_dt = _xp_first(_XP_FIRST_DT, dl)
+                first_dt_text = lxml_text(first_dt) if first_dt is not None else ""
+
+                if "(前回)" in first_dt_text:
+                    label = "前走向け調教"
+                else:
+                    # 空白やそれ以外の場合は今走扱い
+                    label = "今走向け調教"
+
+                # --- 日付・場所・馬場状態 ---
+                dt_left = _xp_first(_XP_DT_LEFT, dl)
+                info_text = lxml_text(dt_left, " ") if dt_left is not None else ""
+                dt_right = _xp_first(_XP_DT_RIGHT, dl)
+                cond_text = lxml_text(dt_right) if dt_right is not None else ""
+
+                # --- タイムデータ (直後の兄弟要素の table を探す) ---
+                next_node = _xp_first(_XP_NEXT_TABLE, dl)
+
+                time_data = ""
+                if next_node is not None and "cyokyodata" in next_node.get("class", "").split():
+                    # テーブル内のテキストを行ごとに取得
+                    data_rows = []
+                    for tr in _XP_ALL_ROWS(next_node):
+                        # タイムや併せ馬情報の取得
+                        cells = [t for t in (lxml_text(td) for td in _XP_ALL_TDS(tr)) if t]
+                        if cells:
+                            data_rows.append(" ".join(cells))
+                    time_data = " / ".join(data_rows)
+
+                # 行を作成: "前走向け調教：12/26 浦和調教場 重 馬なり 59.2 42.8"
+                cyokyo_lines.append(f"{label}：{info_text} {cond_text} {time_data}")
+
+            # 最終的な文字列生成
+            full_text = f"【短評】{tp_txt}"
+            if cyokyo_lines:
+                full_text += "\n" + "\n".join(cyokyo_lines)
+
+            d_cyokyo[uma] = full_text
 
+        except Exception:
+            continue
+    return d_cyokyo
+
+# 解析結果はレース ID 単位でキャッシュ（再実行時に取得・パースをやり直さない）
+# ログイン切れで取れなかった場合は fetch_kb_html が例外を出すのでキャッシュされない
+# 未掲載（空）も例外にして、掲載後の再実行で取り直せるようにする（st.cache_data は例外時に保存しない）
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_kb_danwa(kb_id):
+    cached = race_cache_get("danwa", kb_id)
+    if cached is not None:
+        return cached
+    d_danwa = _parse_kb_danwa(fetch_kb_html(f"https://s.keibabook.co.jp/chihou/danwa/1/{kb_id}"))
+    if not d_danwa:
+        raise LookupError(kb_id)
+    race_cache_set("danwa", kb_id, d_danwa)
+    return d_danwa
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_kb_cyokyo(kb_id):
+    cached = race_cache_get("cyokyo", kb_id)
+    if cached is not None:
+        return cached
+    d_cyokyo = _parse_kb_cyokyo(fetch_kb_html(f"https://s.keibabook.co.jp/chihou/cyokyo/1/{kb_id}"))
+    if not d_cyokyo:
+        raise LookupError(kb_id)
+    race_cache_set("cyokyo", kb_id, d_cyokyo)
+    return d_cyokyo
+
+def parse_kb_danwa_cyokyo(kb_id):
+    d_danwa, d_cyokyo = {}, {}
+    # 片方が未掲載・取得失敗でももう片方は取りに行く
+    try:
+        # --- 厩舎の話 (Danwa) ---
+        d_danwa = _fetch_kb_danwa(kb_id)
     except Exception:
         pass
-    
+    try:
+        # --- 調教 (Cyokyo) ---
+        d_cyokyo = _fetch_kb_cyokyo(kb_id)
+    except Exception:
+        pass
+
     return d_danwa, d_cyokyo
 
 def _parse_grades_from_ai(text):
     grades = {}
-    for line in text.split("\n"):
-        m = re.search(r"([SABCDE])\s*[:：]?\s*([^\s　]+)", line)
-        if m:
-            g, n = m.group(1), re.sub(r"[（\(].*?[）\)]", "", m.group(2)).strip()
-            if n:
-                grades[n] = g
+    for g, raw in _RE_GRADE_LINE.findall(text):
+        n = _RE_PAREN.sub("", raw).strip()
+        if n:
+            grades[n] = g
     return grades
 
-def _fetch_matchup_table_selenium(driver, nankan_id, grades):
-    url = f"https://www.nankankeiba.com/taisen/{nankan_id}.do"
+def _grade_resolver(grades):
+    """馬名 -> AI評価 を引く関数を返す（空白等を除いた名前で完全一致 → 部分一致の順、結果はメモ化）"""
+    norm = {k.translate(_NAME_TRANS): v for k, v in grades.items()}
+    norm.pop("", None)
+    items = tuple(norm.items())
+    memo = {}
+
+    def resolve(name):
+        if name in memo:
+            return memo[name]
+        key = name.translate(_NAME_TRANS)
+        grade = norm.get(key, "")
+        if not grade and key:
+            grade = next((v for k, v in items if k in key or key in k), "")
+        memo[name] = grade
+        return grade
+
+    return resolve
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_matchup_html(nankan_id):
+    # 対戦表は過去走の結果なので当日中は変わらない → ディスクにも残す
+    html = race_cache_get("taisen", nankan_id)
+    if html is None:
+        html = fetch_html(f"https://www.nankankeiba.com/taisen/{nankan_id}.do")
+        # 表がまだ無いページはどちらのキャッシュにも残さない（掲載後の再実行で取り直す）
+        if "nk23_c-table08__table" not in html:
+            raise LookupError(nankan_id)
+        race_cache_set("taisen", nankan_id, html)
+    return html
+
+def _fetch_matchup_table(nankan_id, grades):
     try:
-        driver.get(url)
-        time.sleep(0.5)
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        tbl = soup.find("table", class_="nk23_c-table08__table")
-        if not tbl:
+        try:
+            html = _fetch_matchup_html(nankan_id)
+        except LookupError:
+            return "\n(対戦データなし)"
+        tbls = _XP_MATCHUP_TABLE(lxml_root(html))
+        if not tbls:
             return "\n(対戦データなし)"
+        tbl = tbls[0]
 
         races = []
-        if tbl.find("thead"):
-            for col in tbl.find("thead").find_all(["th", "td"])[2:]:
-                det = col.find(class_="nk23_c-table08__detail")
-                if det:
-                    link = col.find("a")
-                    href = link.get("href", "") if link else ""
-                    full_url = ""
-                    if href:
-                        id_match = re.search(r"(\d{10,})", href)
-                        if id_match:
-                            full_url = f"https://www.nankankeiba.com/result/{id_match.group(1)}.do"
-                        elif href.startswith("/"):
-                            full_url = "https://www.nankankeiba.com" + href
-                        else:
-                            full_url = href
-
-                    races.append({
-                        "title": det.get_text(" ", strip=True),
-                        "url": full_url,
-                        "results": []
-                    })
+        for col in _XP_THEAD_CELLS(tbl)[2:]:
+            det = _XP_DETAIL(col)
+            if det:
+                link = _XP_FIRST_LINK(col)
+                href = link[0].get("href", "") if link else ""
+                full_url = ""
+                if href:
+                    id_match = _RE_RESULT_ID.search(href)
+                    if id_match:
+                        full_url = f"https://www.nankankeiba.com/result/{id_match.group(1)}.do"
+                    elif href.startswith("/"):
+                        full_url = "https://www.nankankeiba.com" + href
+                    else:
+                        full_url = href
+
+                races.append({
+                    "title": lxml_text(det[0], " "),
+                    "url": full_url,
+                    "results": []
+                })
 
         if not races:
             return "\n(初対戦)"
 
-        if tbl.find("tbody"):
-            for tr in tbl.find("tbody").find_all("tr"):
-                u = tr.find("a", class_="nk23_c-table08__text")
-                if not u:
-                    continue
-                name = u.get_text(strip=True)
-                grade = grades.get(name, "")
-                if not grade:
-                    for k, v in grades.items():
-                        if k in name or name in k:
-                            grade = v
-                            break
-                cells = tr.find_all(["td", "th"])
-                idx_st = -1
-                for i, c in enumerate(cells):
-                    if c.find("a", class_="nk23_c-table08__text"):
-                        idx_st = i
-                        break
-                if idx_st == -1:
-                    continue
-                for i, c in enumerate(cells[idx_st + 1:]):
-                    if i >= len(races):
-                        break
-                    rp = c.find("p", class_="nk23_c-table08__number")
-                    rnk = ""
-                    if rp:
-                        sp = rp.find("span")
-                        rnk = sp.get_text(strip=True) if sp else rp.get_text(strip=True).split("｜")[0].strip()
-                    if rnk and (rnk.isdigit() or rnk in ["除外", "中止"]):
-                        races[i]["results"].append({"rank": rnk, "name": name, "grade": grade, "sort": int(rnk) if rnk.isdigit() else 999})
+        grade_of = _grade_resolver(grades)
+        for tr in _XP_TBODY_ROWS(tbl):
+            u = _XP_HORSE_LINK(tr)
+            if not u:
+                continue
+            name = lxml_text(u[0])
+            grade = grade_of(name)
+            cells = _XP_CELLS(tr)
+            idx_st = -1
+            for i, c in enumerate(cells):
+                if _XP_HORSE_LINK(c):
+                    idx_st = i
+                    break
+            if idx_st == -1:
+                continue
+            for i, c in enumerate(cells[idx_st + 1:]):
+                if i >= len(races):
+                    break
+                rp = _XP_RANK_P(c)
+                rnk = ""
+                if rp:
+                    sp = _XP_FIRST_SPAN(rp[0])
+                    rnk = lxml_text(sp[0]) if sp else lxml_text(rp[0]).split("｜")[0].strip()
+                if rnk and (rnk.isdigit() or rnk in ["除外", "中止"]):
+                    races[i]["results"].append({"rank": rnk, "name": name, "grade": grade, "sort": int(rnk) if rnk.isdigit() else 999})
 
         out = ["\n【対戦表（AI評価付き）】"]
         for r in races:
@@ -707,18 +1201,61 @@ def _fetch_matchup_table_selenium(driver, nankan_id, grades):
     except Exception as e:
         return f"(対戦表取得エラー: {e})"
 
+_JS_CHANGE_SHOSAI = "if(typeof changeShosai === 'function'){ changeShosai('s1'); }"
+# 馬番セルに数字が入り、近走(前走)セルに中身が描画されたら true
+_JS_SHOSAI_READY = (
+    "var us=document.querySelectorAll('#shosai_aria td.umaban, #shosai_aria td.is-col02'), ok=false;"
+    "for(var i=0;i<us.length;i++){ if(/^\\s*\\d+\\s*$/.test(us[i].textContent)){ ok=true; break; } }"
+    "if(!ok) return false;"
+    "var zs=document.querySelectorAll('#shosai_aria td.cs-z1');"
+    "for(var j=0;j<zs.length;j++){ if((zs[j].innerText||'').trim().length>=5) return true; }"
+    "return false;"
+)
+
+def _load_shosai_selenium(driver, nk_id, place_name, resources):
+    """requests 取得で出馬表詳細が取れなかった場合のフォールバック（changeShosai を実行して解析）"""
+    # 共有ドライバなので遷移〜page_source 取得までは他のセッションに触らせない（解析はロック外）
+    with _DRIVER_LOCK:
+        driver.get(f"https://www.nankankeiba.com/uma_shosai/{nk_id}.do")
+        driver.execute_script(_JS_CHANGE_SHOSAI)
+        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "shosai_aria")))
+
+        # 固定 sleep + 再パースの代わりに、描画完了をブラウザ内の JS 1回で 0.25 秒ごとに判定する
+        # 間に合わなければ changeShosai をもう一度だけ叩いて待ち直す
+        for _ in range(2):
+            try:
+                WebDriverWait(driver, 5, poll_frequency=0.25).until(lambda d: d.execute_script(_JS_SHOSAI_READY))
+                break
+            except TimeoutException:
+                driver.execute_script(_JS_CHANGE_SHOSAI)
+
+        html = driver.page_source
+    return parse_nankankeiba_detail(html, place_name, resources)
+
+def _predict_race(full_prompt, nk_id):
+    """Dify 予想 → 評価抽出 → 対戦表取得（ワーカースレッドで実行）"""
+    ai_out = run_dify_prediction_cached(full_prompt)
+    grades = _parse_grades_from_ai(ai_out)
+    match_txt = _fetch_matchup_table(nk_id, grades)
+    ai_out_clean = _RE_HR_LINE.sub("", ai_out)
+    ai_out_clean = _RE_BLANK_LINES.sub("\n\n", ai_out_clean).strip()
+    return ai_out_clean, match_txt
+
 # ==================================================
 # 6. ジェネレータ
 # ==================================================
 def run_races_iter(year, month, day, place_code, target_races, mode="dify", **kwargs):
     resources = load_resources()
-    kb_input_map = {"10": "大井", "11": "川崎", "12": "船橋", "13": "浦和"}
-    nk_code_map = {"10": "20", "11": "21", "12": "19", "13": "18"}
-    place_name = kb_input_map.get(place_code, "地方")
-    nk_place_code = nk_code_map.get(place_code)
-    driver = get_driver()
+    place_name = KB_PLACE_NAMES.get(place_code, "地方")
+    nk_place_code = NK_PLACE_CODES.get(place_code)
 
+    # with を使うと、Streamlit の停止・再実行でジェネレータが閉じられたときに shutdown(wait=True) で
+    # 残りの Dify 呼び出し・先読みの完了まで待たされる → 待たずに捨てる
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
     try:
+        # 番組ページ（ログイン不要）は開催特定・ログインと独立なので先に投げておく
+        prog_fut = executor.submit(get_program_race_nums, year, month, day, nk_place_code)
+
         yield {"type": "status", "data": f"📅 開催特定中 ({place_name})..."}
         kai, nichi = get_nankan_kai_nichi(month, day, place_name)
         if not kai:
@@ -726,101 +1263,97 @@ def run_races_iter(year, month, day, place_code, target_races, mode="dify", **kw
             return
         yield {"type": "status", "data": f"✅ {place_name} 第{kai}回 {nichi}日目"}
 
-        yield {"type": "status", "data": "🔑 競馬ブック ログイン中..."}
-        login_keibabook_robust(driver)
-
-        prog_url = f"https://www.nankankeiba.com/program/{year}{month}{day}{nk_place_code}.do"
-        driver.get(prog_url)
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        r_nums = []
-        for a in soup.find_all("a", href=True):
-            if f"{year}{month}{day}{nk_place_code}" in a["href"] and "uma_shosai" not in a["href"]:
-                f = a["href"].split("/")[-1].replace(".do", "")
-                if len(f) == 16:
-                    r_nums.append(int(f[14:16]))
-        r_nums = sorted(list(set(r_nums))) or range(1, 13)
+        # 保存済み Cookie が生きていればブラウザを起動せずに進む
+        if load_kb_cookies():
+            yield {"type": "status", "data": "🔑 競馬ブック 保存済みログインを使用"}
+        else:
+            yield {"type": "status", "data": "🔑 競馬ブック ログイン中..."}
+            get_logged_in_driver()
+
+        r_nums = [r for r in prog_fut.result() if not target_races or r in target_races]
+
+        # 南関の出馬表詳細・競馬ブックの談話/調教は全レース分を先に並列取得しておく
+        nk_ids = {r: f"{year}{month}{day}{nk_place_code}{kai:02}{nichi:02}{r:02}" for r in r_nums}
+        shosai_futs = {
+            r: executor.submit(fetch_html, f"https://www.nankankeiba.com/uma_shosai/{nk_id}.do")
+            for r, nk_id in nk_ids.items()
+        }
+        kb_fmt = kb_url_id_format(year, month, day, place_code)
+        kb_futs = {r: executor.submit(parse_kb_danwa_cyokyo, kb_fmt % (nichi, r)) for r in r_nums}
+        # 対戦表 HTML も先に投げてキャッシュを温めておく（後の _fetch_matchup_table はキャッシュから読む）
+        for nk_id in nk_ids.values():
+            executor.submit(_fetch_matchup_html, nk_id)
+        predict_futs = {}
 
         for r_num in r_nums:
-            if target_races and r_num not in target_races:
-                continue
-
             yield {"type": "status", "data": f"🏇 {r_num}R データ解析中..."}
 
             try:
-                nk_id = f"{year}{month}{day}{nk_place_code}{kai:02}{nichi:02}{r_num:02}"
-                kb_id = get_kb_url_id(year, month, day, place_code, nichi, r_num)
-
-                result_url = f"https://www.nankankeiba.com/result/{nk_id}.do"
+                nk_id = nk_ids[r_num]
+                danwa, cyokyo = kb_futs[r_num].result()
 
-                danwa, cyokyo = parse_kb_danwa_cyokyo(driver, kb_id)
-
-                driver.get(f"https://www.nankankeiba.com/uma_shosai/{nk_id}.do")
+                nk_data = {"meta": {}, "horses": {}}
                 try:
-                    driver.execute_script("if(typeof changeShosai === 'function'){ changeShosai('s1'); }")
-                    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "shosai_aria")))
-                    time.sleep(1.0)
-                except TimeoutException:
-                    yield {"type": "error", "data": f"{r_num}R 詳細データ読み込みタイムアウト"}
-                    continue
-
-                nk_data = parse_nankankeiba_detail(driver.page_source, place_name, resources)
-
-                # リトライロジック
-                if not nk_data["horses"]:
-                    for _ in range(2):
-                        time.sleep(1)
-                        driver.execute_script("if(typeof changeShosai === 'function'){ changeShosai('s1'); }")
-                        time.sleep(1)
-                        nk_data = parse_nankankeiba_detail(driver.page_source, place_name, resources)
-                        if nk_data["horses"]:
-                            break
+                    nk_data = parse_nankankeiba_detail(shosai_futs[r_num].result(), place_name, resources)
+                except Exception:
+                    pass
+
+                # 近走セルは JS（changeShosai）で描画されるので、生 HTML で1頭も近走が取れなければブラウザで取り直す
+                # （_JS_SHOSAI_READY と同じ判定。新馬戦などで本当に近走が無ければ生 HTML の結果を使う）
+                if not any(h["hist"] for h in nk_data["horses"].values()):
+                    try:
+                        sel_data = _load_shosai_selenium(get_logged_in_driver(), nk_id, place_name, resources)
+                        if sel_data["horses"]:
+                            nk_data = sel_data
+                    except TimeoutException:
+                        if not nk_data["horses"]:
+                            yield {"type": "error", "data": f"{r_num}R 詳細データ読み込みタイムアウト"}
+                            continue
 
                 if not nk_data["horses"]:
                     yield {"type": "error", "data": f"{r_num}R データなし (HTML解析失敗)"}
                     continue
 
                 header = f"レース名:{r_num}R {nk_data['meta'].get('race_name','')} 格:{nk_data['meta'].get('grade','')} コース:{nk_data['meta'].get('course','')}"
-                horse_texts = []
+                # 1つのリストに全行を積んで最後に1回だけ join する（馬ごとは空行区切り）
+                out = [header]
                 for u in sorted(nk_data["horses"].keys(), key=int):
                     h = nk_data["horses"][u]
 
                     power_line = h.get("display_power", f"【騎手】{h['power']}、 相性:{h['compat']}")
 
-                    block = [
-                        f"[{u}]{h['name']} 騎:{h['jockey']} 師:{h['trainer']}",
-                        f"話:{danwa.get(u,'なし')}",
-                        f"調:{cyokyo.get(u,'データなし')}",
-                        power_line,
-                        "【近走】"
-                    ]
-                    for idx, hs in enumerate(h["hist"]):
-                        block.append(f"{hs}")
-                    horse_texts.append("\n".join(block))
+                    out.append(_HORSE_BLOCK_TMPL % (
+                        u, h["name"], h["jockey"], h["trainer"],
+                        danwa.get(u, "なし"), cyokyo.get(u, "データなし"), power_line,
+                    ))
+                    out.extend(h["hist"])
 
-                full_prompt = header + "\n\n" + "\n\n".join(horse_texts)
+                full_prompt = "\n".join(out)
 
                 if mode == "raw":
                     yield {"type": "status", "data": f"🔍 {r_num}R 対戦データを取得中..."}
-                    match_txt = _fetch_matchup_table_selenium(driver, nk_id, grades={})
+                    match_txt = _fetch_matchup_table(nk_id, grades={})
+                    final_text = f"📅 {year}/{month}/{day} {place_name}{r_num}R\n\n{full_prompt}\n\n{match_txt}"
                     yield {"type": "result", "race_num": r_num, "data": final_text}
-                    time.sleep(1)
                     continue
 
                 yield {"type": "status", "data": f"🤖 {r_num}R AI予測中..."}
-                ai_out = run_dify_prediction(full_prompt)
-                grades = _parse_grades_from_ai(ai_out)
-                match_txt = _fetch_matchup_table_selenium(driver, nk_id, grades)
-                ai_out_clean = re.sub(r"^\s*-{3,}\s*$", "", ai_out, flags=re.MULTILINE)
-                ai_out_clean = re.sub(r"\n{3,}", "\n\n", ai_out_clean).strip()
+                predict_futs[executor.submit(_predict_race, full_prompt, nk_id)] = r_num
 
+            except Exception as e:
+                yield {"type": "error", "data": f"{r_num}R Error: {e}"}
+
+        # AI予測は完了した順に返す
+        for fut in as_completed(predict_futs):
+            r_num = predict_futs[fut]
+            try:
+                ai_out_clean, match_txt = fut.result()
                 final_text = f"📅 {year}/{month}/{day} {place_name}{r_num}R\n\n=== 🤖AI予想 ===\n{ai_out_clean}\n\n{match_txt}"
                 yield {"type": "result", "race_num": r_num, "data": final_text}
-                time.sleep(15)
-
             except Exception as e:
                 yield {"type": "error", "data": f"{r_num}R Error: {e}"}
 
     except Exception as e:
         yield {"type": "error", "data": f"Fatal: {e}"}
     finally:
-        driver.quit()
+        executor.shutdown(wait=False, cancel_futures=True)